@@ -17,15 +17,21 @@ Usage:
 """
 
 import argparse
-import json
 import os
 import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 import audible
+import ijson
+import orjson
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
@@ -33,10 +39,31 @@ load_dotenv()
 SCRIPT_DIR = Path(__file__).parent
 AUTH_FILE = SCRIPT_DIR / "audible_auth.json"
 LIBRARY_FILE = SCRIPT_DIR / "audible_library.json"
+ABS_CACHE_FILE = SCRIPT_DIR / "abs_cache.json"
+ABS_CACHE_TTL = 3600
 
 # Audiobookshelf config
 ABS_URL = os.getenv("ABS_URL", "").rstrip("/")
 ABS_TOKEN = os.getenv("ABS_TOKEN", "")
+ABS_PAGE_SIZE = 500
+ABS_TIMEOUT = (5, 30)
+
+# Shared connection pool for all Audiobookshelf requests
+SESSION = requests.Session()
+SESSION.headers["Authorization"] = f"Bearer {ABS_TOKEN}"
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # Hand the last response to raise_for_status() instead of raising RetryError
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 
 def authenticate():
@@ -83,22 +110,15 @@ def extract_library():
 
         # Process and categorize
         processed = []
-        stats = {"finished": 0, "in_progress": 0, "not_started": 0}
+        counts = Counter()
 
         for item in items:
             ls = item.get("listening_status") or {}
             pct = ls.get("percent_complete", 0) or 0
             is_finished = item.get("is_finished", False)
 
-            if is_finished:
-                state = "finished"
-                stats["finished"] += 1
-            elif pct > 0:
-                state = "in_progress"
-                stats["in_progress"] += 1
-            else:
-                state = "not_started"
-                stats["not_started"] += 1
+            state = "finished" if is_finished else "in_progress" if pct > 0 else "not_started"
+            counts[state] += 1
 
             processed.append({
                 "asin": item.get("asin", ""),
@@ -108,16 +128,17 @@ def extract_library():
                 "state": state,
             })
 
+        stats = {"finished": counts["finished"], "in_progress": counts["in_progress"], "not_started": counts["not_started"]}
+
         # Save to file
         output = {
-            "extracted_at": datetime.now().isoformat(),
+            "extracted_at": datetime.now(),
             "total_items": len(processed),
             "stats": stats,
             "items": processed,
         }
 
-        with open(LIBRARY_FILE, "w") as f:
-            json.dump(output, f, indent=2)
+        LIBRARY_FILE.write_bytes(orjson.dumps(output, option=orjson.OPT_INDENT_2))
 
         print(f"\nLibrary saved to {LIBRARY_FILE}")
         print(f"\nStats:")
@@ -129,6 +150,113 @@ def extract_library():
         return output
 
 
+def load_abs_cache(cache_key):
+    """Return cached Audiobookshelf library items if still fresh, else None."""
+    if not ABS_CACHE_FILE.exists():
+        return None
+
+    try:
+        cache = orjson.loads(ABS_CACHE_FILE.read_bytes())
+    except orjson.JSONDecodeError:
+        return None
+
+    if cache.get("key") != cache_key:
+        return None
+    if time.time() - cache.get("mtime", 0) > ABS_CACHE_TTL:
+        return None
+
+    return cache.get("items")
+
+
+def save_abs_cache(cache_key, library_items):
+    """Persist Audiobookshelf library items for the next run."""
+    cache = {
+        "mtime": int(time.time()),
+        "key": cache_key,
+        "items": library_items,
+    }
+    ABS_CACHE_FILE.write_bytes(orjson.dumps(cache))
+
+
+def fetch_abs_libraries():
+    """Fetch Audiobookshelf libraries and a key that changes when their contents do."""
+    resp = SESSION.get(f"{ABS_URL}/api/libraries", timeout=ABS_TIMEOUT)
+    resp.raise_for_status()
+    libraries = orjson.loads(resp.content).get("libraries", [])
+
+    def fetch_total(lib):
+        resp = SESSION.get(
+            f"{ABS_URL}/api/libraries/{lib['id']}/items",
+            params={"limit": 1, "page": 0},
+            timeout=ABS_TIMEOUT,
+        )
+        resp.raise_for_status()
+        return orjson.loads(resp.content).get("total", 0)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        totals = list(executor.map(fetch_total, libraries))
+
+    cache_key = {
+        "url": ABS_URL,
+        "libraries": [[lib["id"], lib.get("lastUpdate"), total] for lib, total in zip(libraries, totals)],
+    }
+    return libraries, cache_key
+
+
+def fetch_abs_library_items(libraries):
+    """Fetch every item in the given Audiobookshelf libraries, without progress."""
+    def fetch_page(lib_id, page):
+        resp = SESSION.get(
+            f"{ABS_URL}/api/libraries/{lib_id}/items",
+            params={"limit": ABS_PAGE_SIZE, "page": page},
+            timeout=ABS_TIMEOUT,
+        )
+        resp.raise_for_status()
+        return orjson.loads(resp.content)
+
+    # Pages are independent, so fetch them concurrently: the first page of
+    # every library reports its total, then the remaining pages fan out
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        first_pages = list(executor.map(lambda lib: fetch_page(lib["id"], 0), libraries))
+        pending = []
+        for lib, first in zip(libraries, first_pages):
+            page_count = -(-first.get("total", 0) // ABS_PAGE_SIZE)
+            pending.append([executor.submit(fetch_page, lib["id"], page) for page in range(1, page_count)])
+
+        fetched = []
+        for lib, first, futures in zip(libraries, first_pages, pending):
+            items = first.get("results", [])
+            for future in futures:
+                items.extend(future.result().get("results", []))
+            fetched.append((lib, items))
+
+    library_items = []
+
+    for lib, items in fetched:
+        lib_id = lib["id"]
+        lib_name = lib["name"]
+        print(f"Fetched library: {lib_name}")
+        print(f"  Found {len(items)} items")
+
+        for item in items:
+            media = item.get("media") or {}
+            meta = media.get("metadata") or {}
+            # Try direct duration first, then sum from audio files
+            duration = media.get("duration", 0) or sum(f.get("duration", 0) for f in media.get("audioFiles", []))
+
+            library_items.append({
+                "id": item["id"],
+                "library_id": lib_id,
+                "library_name": lib_name,
+                "title": meta.get("title", ""),
+                "authors": [a.get("name", "") for a in meta.get("authors") or ()],
+                "asin": meta.get("asin", ""),
+                "duration": duration,
+            })
+
+    return library_items
+
+
 def get_audiobookshelf_library():
     """Fetch library from Audiobookshelf with user progress."""
     if not ABS_URL or not ABS_TOKEN:
@@ -136,12 +264,10 @@ def get_audiobookshelf_library():
         print("Set them in .env or environment")
         sys.exit(1)
 
-    headers = {"Authorization": f"Bearer {ABS_TOKEN}"}
-
     # Get user's media progress
-    resp = requests.get(f"{ABS_URL}/api/me", headers=headers)
+    resp = SESSION.get(f"{ABS_URL}/api/me", timeout=ABS_TIMEOUT)
     resp.raise_for_status()
-    user_data = resp.json()
+    user_data = orjson.loads(resp.content)
 
     # Build progress lookup by libraryItemId
     progress_by_item = {}
@@ -152,46 +278,43 @@ def get_audiobookshelf_library():
             "current_time": p.get("currentTime", 0),
         }
 
-    # Get all libraries
-    resp = requests.get(f"{ABS_URL}/api/libraries", headers=headers)
-    resp.raise_for_status()
-    libraries = resp.json().get("libraries", [])
+    # The library listing is the expensive part; reuse it while fresh
+    libraries, cache_key = fetch_abs_libraries()
+    library_items = load_abs_cache(cache_key)
+    if library_items is None:
+        library_items = fetch_abs_library_items(libraries)
+        save_abs_cache(cache_key, library_items)
+    else:
+        print(f"Using cached Audiobookshelf library ({len(library_items)} items)")
 
-    all_items = []
+    default_progress = {"is_finished": False, "progress": 0, "current_time": 0}
+    get_progress = progress_by_item.get
 
-    for lib in libraries:
-        lib_id = lib["id"]
-        lib_name = lib["name"]
-        print(f"Fetching library: {lib_name}")
+    all_items = []
+    for item in library_items:
+        progress = get_progress(item["id"], default_progress)
+        all_items.append({
+            **item,
+            "is_finished": progress["is_finished"],
+            "progress": progress["progress"],
+            "current_time": progress["current_time"],
+        })
 
-        # Get all items in this library
-        resp = requests.get(
-            f"{ABS_URL}/api/libraries/{lib_id}/items",
-            headers=headers,
-            params={"limit": 0},
-        )
-        resp.raise_for_status()
+    return all_items
 
-        items = resp.json().get("results", [])
-        print(f"  Found {len(items)} items")
 
-        for item in items:
-            item_id = item["id"]
-            progress = progress_by_item.get(item_id, {"is_finished": False, "progress": 0, "current_time": 0})
+def normalize_asin(asin):
+    """Normalize an ASIN so Audible and Audiobookshelf values compare equal."""
+    return asin.strip().upper() if asin else ""
 
-            all_items.append({
-                "id": item_id,
-                "library_id": lib_id,
-                "library_name": lib_name,
-                "title": item.get("media", {}).get("metadata", {}).get("title", ""),
-                "authors": [a.get("name", "") for a in item.get("media", {}).get("metadata", {}).get("authors", [])],
-                "asin": item.get("media", {}).get("metadata", {}).get("asin", ""),
-                "is_finished": progress["is_finished"],
-                "progress": progress["progress"],
-                "current_time": progress["current_time"],
-            })
 
-    return all_items
+def iter_audible_items():
+    """Stream Audible items from the library file without loading it whole."""
+    with open(LIBRARY_FILE, "rb") as f:
+        # Handle both old flat format and new wrapped format
+        prefix = "item" if f.read(64).lstrip().startswith(b"[") else "items.item"
+        f.seek(0)
+        yield from ijson.items(f, prefix, use_float=True)
 
 
 def compare():
@@ -202,34 +325,8 @@ def compare():
         print("Run 'extract' command first")
         sys.exit(1)
 
-    with open(LIBRARY_FILE) as f:
-        data = json.load(f)
-
-    # Handle both old flat format and new wrapped format
-    if isinstance(data, list):
-        audible_items = data
-        aud_stats = None
-    else:
-        audible_items = data.get("items", [])
-        aud_stats = data.get("stats")
-
-    # Count stats if not available
-    if not aud_stats:
-        aud_stats = {"finished": 0, "in_progress": 0, "not_started": 0}
-        for item in audible_items:
-            if item.get("is_finished", False):
-                aud_stats["finished"] += 1
-            elif item.get("percent_complete", 0) > 0:
-                aud_stats["in_progress"] += 1
-            else:
-                aud_stats["not_started"] += 1
-
-    print(f"Audible: {len(audible_items)} items")
-    print(f"  Finished: {aud_stats['finished']}, In progress: {aud_stats.get('in_progress', 0)}, Not started: {aud_stats.get('not_started', 0)}")
-
     # Fetch Audiobookshelf
     abs_items = get_audiobookshelf_library()
-    print(f"\nAudiobookshelf: {len(abs_items)} items")
 
     # Stats for Audiobookshelf
     abs_stats = {"finished": 0, "has_progress": 0, "no_progress": 0}
@@ -241,51 +338,66 @@ def compare():
         else:
             abs_stats["no_progress"] += 1
 
-    print(f"  Finished: {abs_stats['finished']}, Has progress: {abs_stats['has_progress']}, No progress: {abs_stats['no_progress']}")
-
     # Try to match by ASIN
-    abs_by_asin = {item["asin"]: item for item in abs_items if item["asin"]}
+    abs_by_asin = {asin: item for item in abs_items if (asin := normalize_asin(item["asin"]))}
+    abs_get = abs_by_asin.get
+
+    # Audible stats are counted during the streaming pass
+    aud_total = finished = in_progress = not_started = 0
 
     matched = 0
     unmatched_audible = []
-    needs_update = []
+    to_finish = []
+    to_progress = []
+
+    for aud_item in iter_audible_items():
+        aud_finished = aud_item.get("is_finished", False)
+        aud_pct = aud_item.get("percent_complete", 0) or 0
+
+        aud_total += 1
+        if aud_finished:
+            finished += 1
+        elif aud_pct > 0:
+            in_progress += 1
+        else:
+            not_started += 1
 
-    for aud_item in audible_items:
-        asin = aud_item.get("asin", "")
-        if asin in abs_by_asin:
+        asin = normalize_asin(aud_item.get("asin"))
+        abs_item = abs_get(asin) if asin else None
+        if abs_item is not None:
             matched += 1
-            abs_item = abs_by_asin[asin]
 
-            aud_finished = aud_item.get("is_finished", False)
-            aud_pct = aud_item.get("percent_complete", 0) or 0
             abs_finished = abs_item["is_finished"]
             abs_progress = abs_item["progress"]
             abs_current_time = abs_item["current_time"]
 
             # Check if update needed
             if aud_finished and not abs_finished:
-                needs_update.append({
+                to_finish.append({
                     "title": aud_item.get("title", "Unknown"),
                     "asin": asin,
                     "abs_id": abs_item["id"],
-                    "action": "mark_finished",
                     "aud_pct": aud_pct,
                 })
             elif aud_pct > 0 and not abs_finished and abs_progress == 0 and abs_current_time == 0:
                 # Has progress in Audible but none in ABS
-                needs_update.append({
+                to_progress.append({
                     "title": aud_item.get("title", "Unknown"),
                     "asin": asin,
                     "abs_id": abs_item["id"],
-                    "action": "set_progress",
                     "aud_pct": aud_pct,
+                    "duration": abs_item["duration"],
                 })
         else:
             unmatched_audible.append(aud_item)
 
-    # Categorize updates
-    to_finish = [u for u in needs_update if u["action"] == "mark_finished"]
-    to_progress = [u for u in needs_update if u["action"] == "set_progress"]
+    aud_stats = {"finished": finished, "in_progress": in_progress, "not_started": not_started}
+
+    print(f"\nAudible: {aud_total} items")
+    print(f"  Finished: {aud_stats['finished']}, In progress: {aud_stats['in_progress']}, Not started: {aud_stats['not_started']}")
+
+    print(f"\nAudiobookshelf: {len(abs_items)} items")
+    print(f"  Finished: {abs_stats['finished']}, Has progress: {abs_stats['has_progress']}, No progress: {abs_stats['no_progress']}")
 
     print(f"\nMatching:")
     print(f"  Matched by ASIN: {matched}")
@@ -304,7 +416,8 @@ def compare():
         "abs_stats": abs_stats,
         "matched": matched,
         "unmatched": len(unmatched_audible),
-        "needs_update": needs_update,
+        "to_finish": to_finish,
+        "to_progress": to_progress,
     }
 
 
@@ -312,16 +425,13 @@ def sync(dry_run=False):
     """Sync Audible progress to Audiobookshelf."""
     # Run compare to get what needs updating
     result = compare()
-    needs_update = result["needs_update"]
+    to_finish = result["to_finish"]
+    to_progress = result["to_progress"]
 
-    if not needs_update:
+    if not to_finish and not to_progress:
         print("\nNothing to sync - all matched items are already correct!")
         return
 
-    # Categorize
-    to_finish = [u for u in needs_update if u["action"] == "mark_finished"]
-    to_progress = [u for u in needs_update if u["action"] == "set_progress"]
-
     print(f"\n{'DRY RUN - ' if dry_run else ''}Sync plan:")
     print(f"  Mark finished: {len(to_finish)}")
     print(f"  Set progress: {len(to_progress)}")
@@ -342,70 +452,49 @@ def sync(dry_run=False):
                 print(f"  ... and {len(to_progress) - 10} more")
         return
 
-    headers = {"Authorization": f"Bearer {ABS_TOKEN}"}
-
-    updated = 0
-    errors = 0
+    def patch_progress(item, payload):
+        resp = SESSION.patch(f"{ABS_URL}/api/me/progress/{item['abs_id']}", json=payload, timeout=ABS_TIMEOUT)
+        resp.raise_for_status()
 
-    # Process finished items
-    for item in to_finish:
+    def finish_item(item):
+        """Mark one item finished, returning (ok, message)."""
         try:
-            resp = requests.patch(
-                f"{ABS_URL}/api/me/progress/{item['abs_id']}",
-                headers=headers,
-                json={"isFinished": True},
-            )
-            resp.raise_for_status()
-            updated += 1
-            print(f"  ✓ [finished] {item['title'][:55]}")
+            patch_progress(item, {"isFinished": True})
+            return True, f"  ✓ [finished] {item['title'][:55]}"
         except Exception as e:
-            errors += 1
-            print(f"  ✗ {item['title'][:40]}: {e}")
+            return False, f"  ✗ {item['title'][:40]}: {e}"
 
-    # Process in-progress items
-    for item in to_progress:
+    def progress_item(item):
+        """Set one item's progress, returning (ok, message)."""
         try:
             pct = item["aud_pct"]
             progress = pct / 100.0
-
-            # Get item duration for currentTime calculation
-            item_resp = requests.get(
-                f"{ABS_URL}/api/items/{item['abs_id']}",
-                headers=headers,
-            )
-            duration = 0
-            if item_resp.ok:
-                media = item_resp.json().get("media", {})
-                # Try direct duration first, then sum from audio files
-                duration = media.get("duration", 0)
-                if not duration:
-                    audio_files = media.get("audioFiles", [])
-                    duration = sum(f.get("duration", 0) for f in audio_files)
-
+            duration = item["duration"]
             current_time = duration * progress
 
             # Treat >95% as finished
             if pct > 95:
-                resp = requests.patch(
-                    f"{ABS_URL}/api/me/progress/{item['abs_id']}",
-                    headers=headers,
-                    json={"progress": 1.0, "currentTime": duration, "isFinished": True},
-                )
-                resp.raise_for_status()
+                patch_progress(item, {"progress": 1.0, "currentTime": duration, "isFinished": True})
+                return True, f"  ✓ [{pct:5.1f}% → finished] {item['title'][:50]}"
+
+            patch_progress(item, {"progress": progress, "currentTime": current_time, "isFinished": False})
+            return True, f"  ✓ [{pct:5.1f}%] {item['title'][:55]}"
+        except Exception as e:
+            return False, f"  ✗ {item['title'][:40]}: {e}"
+
+    updated = 0
+    errors = 0
+
+    # Each PATCH is independent, so issue them concurrently
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        finish_results = executor.map(finish_item, to_finish)
+        progress_results = executor.map(progress_item, to_progress)
+        for ok, message in [*finish_results, *progress_results]:
+            if ok:
                 updated += 1
-                print(f"  ✓ [{pct:5.1f}% → finished] {item['title'][:50]}")
             else:
-                resp = requests.patch(
-                    f"{ABS_URL}/api/me/progress/{item['abs_id']}",
-                    headers=headers,
-                    json={"progress": progress, "currentTime": current_time, "isFinished": False},
-                )
-                resp.raise_for_status()
-                updated += 1
-                print(f"  ✓ [{pct:5.1f}%] {item['title'][:55]}")
-        except Exception as e:
-            errors += 1
-            print(f"  ✗ {item['title'][:40]}: {e}")
+                errors += 1
+            print(message)
 
     print(f"\nSync complete:")
     print(f"  Updated: {updated}")